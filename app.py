@@ -1,78 +1,461 @@
-import os
-import json
-import requests
-from fastapi import FastAPI, Request, HTTPException
-from pydantic import BaseModel
-from openai import OpenAI
+import re
+import atexit
+import time
+import hashlib
+import queue
+import random
+import logging
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, Union
+from urllib.parse import unquote_to_bytes
+
+import httpx
+import orjson
+from fastapi import BackgroundTasks, FastAPI, Request, HTTPException
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, PrivateAttr, ValidationError, model_validator
+from openai import AsyncOpenAI
+
+from config import (
+    AUTHORIZED_SUBDOMAIN,
+    EMBEDDING_MODEL,
+    ERIKA_SYSTEM_PROMPT,
+    JSON_HEADERS,
+    KOMMO_API_URL,
+    KOMMO_JSON_HEADERS,
+    LOG_LEVEL,
+    MAX_RUN_SECONDS,
+    OPENAI_API_KEY,
+    OPENAI_ASSISTANT_ID,
+    OPENAI_CHAT_MODEL,
+    SEMANTIC_CACHE_ENABLED,
+    SEMANTIC_CACHE_THRESHOLD,
+    STAGE_STATUS_IDS,
+)
 
 # ============================================================
-# CONFIGURAÇÕES
+# CLIENTES E ESTADO EM MEMÓRIA
 # ============================================================
 
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
-OPENAI_ASSISTANT_ID = os.getenv("OPENAI_ASSISTANT_ID", "")  # Assistente da Erika
-KOMMO_TOKEN = os.getenv("KOMMO_TOKEN", "")
-KOMMO_DOMAIN = os.getenv("KOMMO_DOMAIN", "")
+client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+
+# Cliente HTTP assíncrono compartilhado para o return_url (keep-alive
+# entre webhooks com o domínio de continuação do Kommo)
+http_client = httpx.AsyncClient(
+    timeout=10,
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        retries=2,  # só falhas de conexão; 429 é repetido no request_with_retry
+    ),
+)
+
+# Cliente dedicado à API do Kommo: base_url e Authorization definidos uma vez,
+# pool próprio de conexões keep-alive com o domínio da conta
+kommo_client = httpx.AsyncClient(
+    base_url=KOMMO_API_URL,
+    headers=KOMMO_JSON_HEADERS,
+    timeout=10,
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+        retries=3,
+    ),
+)
+
+# Localiza o subdomínio da conta nos bytes crus, antes de qualquer parse
+_SUBDOMAIN_JSON_RE = re.compile(rb'"subdomain"\s*:\s*"([^"]+)"')
+_SUBDOMAIN_FORM_RE = re.compile(rb"(?:^|&)account(?:\[|%5B)subdomain(?:\]|%5D)=([^&]*)", re.IGNORECASE)
+
+# Campos lidos do fallback form-urlencoded -> caminho no KommoPayload
+_FORM_FIELDS = {
+    b"token": ("token",),
+    b"return_url": ("return_url",),
+    b"account[subdomain]": ("account", "subdomain"),
+    b"data[message]": ("data", "message"),
+    b"data[message][text]": ("data", "message", "text"),
+    b"data[message][body]": ("data", "message", "body"),
+    b"data[text]": ("data", "text"),
+    b"data[lead_id]": ("data", "lead_id"),
+    b"data[lead][id]": ("data", "lead", "id"),
+    b"message[text]": ("data", "message", "text"),
+    b"message[body]": ("data", "message", "body"),
+    b"message[message]": ("data", "message", "message"),
+    b"message[add][0][text]": ("data", "message", "text"),
+    b"message[add][0][entity_id]": ("data", "lead_id"),
+    b"lead[id]": ("data", "lead_id"),
+    b"leads[0][id]": ("data", "lead_id"),
+}
 
-if not OPENAI_API_KEY:
-    raise RuntimeError("OPENAI_API_KEY não configurada.")
+# Tamanho máximo aceito no corpo do webhook (o widget_request tem poucos KB)
+MAX_BODY_BYTES = 1024 * 1024
+
+# Repetição das chamadas HTTP feitas em segundo plano
+RETRY_ATTEMPTS = 4
+RETRY_BACKOFF_BASE = 4  # esperas de 1s, 4s, 16s (+ jitter de até 1s)
+RETRY_MAX_DELAY = 64  # teto para um Retry-After informado pelo servidor
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Um POST só é repetido se nunca saiu daqui (falha de conexão) ou se foi
+# recusado com 429; após timeout de leitura ou 5xx o servidor pode já ter
+# gravado as notas / continuado o Salesbot
+RETRY_UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+RETRY_UNSAFE_STATUSES = {429}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+# Marcadores da saída do Assistant
+VISIBLE_MARKER = "---VISIBLE---"
+ACTION_MARKER = "---ERIKA_ACTION---"
+
+# Respostas de contingência (nunca entram no cache)
+ERIKA_BUSY_REPLY = "Desculpe, estou com dificuldades para responder agora. 😔"
+ERIKA_ERROR_REPLY = "Ops! Algo deu errado ao falar com a Erika."
+
+# Webhooks já aceitos (o Kommo reenvia os lentos): chave -> expira_em
+WEBHOOK_DEDUP_TTL = 5 * 60
+WEBHOOK_DEDUP_MAX = 10_000
+SEEN_WEBHOOKS = {}
+
+# Limite de leads mantidos em cada estrutura em memória (os mais antigos saem primeiro)
+MAX_CACHED_LEADS = 5000
+
+# Thread do Assistant reaproveitado por lead (contexto + cache de prefixo na OpenAI)
+LEAD_THREAD_TTL = 7 * 24 * 60 * 60
+LEAD_THREADS = {}  # lead_id -> (thread_id, expira_em)
+LEAD_LOCKS = {}  # lead_id -> asyncio.Lock
+
+# Histórico curto por lead no modo Chat Completions (mesmo TTL dos threads)
+ERIKA_HISTORY_MESSAGES = 20
+LEAD_HISTORY = {}  # lead_id -> (deque[mensagens], expira_em)
+
+# Cache semântico de respostas da Erika, por lead
+SEMANTIC_CACHE_TTL = 24 * 60 * 60
+SEMANTIC_CACHE_PER_LEAD = 20
+
+# lead_id -> {"last_reply": str | None, "entries": deque[(expira_em, embedding, contexto, resposta)]}
+SEMANTIC_CACHE = {}
+
+# Handlers só enfileiram; a escrita no stdout acontece na thread do QueueListener
+_log_queue = queue.Queue(-1)
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter(
+    "%(asctime)s.%(msecs)03d - %(levelname)s - %(message)s",
+    datefmt="%H:%M:%S",
+))
+log_listener = QueueListener(_log_queue, _log_stream)
+logging.root.addHandler(QueueHandler(_log_queue))
+logging.root.setLevel(LOG_LEVEL)
+log_listener.start()
+atexit.register(log_listener.stop)  # esvazia a fila ao encerrar o processo
+
+logger = logging.getLogger("kommo")
+# O httpx registra cada requisição em INFO; nossas próprias linhas já cobrem isso
+logging.getLogger("httpx").setLevel(max(logging.WARNING, logger.getEffectiveLevel()))
 
-if not OPENAI_ASSISTANT_ID:
-    raise RuntimeError("OPENAI_ASSISTANT_ID não configurada.")
+# ============================================================
+# MODELOS DO PAYLOAD
+# ============================================================
 
-if not KOMMO_TOKEN:
-    raise RuntimeError("KOMMO_TOKEN não configurado.")
+class KommoMessage(BaseModel):
+    model_config = ConfigDict(extra="allow", coerce_numbers_to_str=True)
 
-if not KOMMO_DOMAIN:
-    raise RuntimeError("KOMMO_DOMAIN não configurado.")
+    text: Optional[str] = None
+    body: Optional[str] = None
+    message: Optional[str] = None
 
-client = OpenAI(api_key=OPENAI_API_KEY)
 
-# Mapear etapas do funil (opcional)
-STAGE_ENV_MAP = {
-    "novo": "123456",
-    "qualificacao": "654321"
-}
+class KommoLead(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    id: Optional[int] = None
+
+
+class KommoData(BaseModel):
+    model_config = ConfigDict(extra="allow", coerce_numbers_to_str=True)
+
+    message: Union[KommoMessage, str, None] = None
+    text: Optional[str] = None
+    lead: Optional[KommoLead] = None
+    lead_id: Optional[int] = None
+
+    # Derivado na validação; não é campo do payload
+    _message_text: str = PrivateAttr(default="")
+
+    @model_validator(mode="after")
+    def _resolve_fallbacks(self):
+        """
+        Resolve uma única vez, na validação, os fallbacks de texto e lead_id
+        """
+        msg_raw = self.message
+        if isinstance(msg_raw, KommoMessage):
+            msg_raw = msg_raw.text or msg_raw.body or msg_raw.message
+        # Objeto message sem texto (ex: {}) ainda cai no data.text
+        msg_raw = msg_raw or self.text or ""
+        self._message_text = msg_raw.strip()
+
+        if self.lead and self.lead.id:
+            self.lead_id = self.lead.id
+        return self
+
+    @property
+    def message_text(self) -> str:
+        return self._message_text
+
+
+class KommoAccount(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    subdomain: Optional[str] = None
+
+
+class KommoPayload(BaseModel):
+    """
+    Payload do widget_request (validado pelo pydantic-core, em Rust)
+    """
+    model_config = ConfigDict(extra="allow")
+
+    token: Optional[str] = None
+    account: Optional[KommoAccount] = None
+    data: Optional[KommoData] = None
+    return_url: Optional[str] = None
+
 
 # ============================================================
 # FUNÇÕES DE APOIO
 # ============================================================
 
-def log(*args):
-    print("[LOG]", *args, flush=True)
+def _retry_delay(attempt: int, response=None) -> float:
+    """
+    Espera antes da próxima tentativa: Retry-After do servidor, se houver,
+    senão backoff exponencial com jitter
+    """
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                delay = None
+        if delay is not None:
+            return min(max(delay, 0.0), RETRY_MAX_DELAY)
+
+    return RETRY_BACKOFF_BASE ** attempt + random.uniform(0, 1)
 
 
-def add_kommo_note(lead_id: int, text: str):
+async def request_with_retry(
+    http: httpx.AsyncClient, method: str, url: str, idempotent: Optional[bool] = None, **kwargs
+) -> httpx.Response:
     """
-    Adiciona nota ao lead no Kommo
+    Requisição HTTP com novas tentativas para falhas transitórias (rede, 429, 5xx);
+    requisições não idempotentes só repetem quando não chegaram ao servidor
     """
-    url = f"https://{KOMMO_DOMAIN}/api/v4/leads/{lead_id}/notes"
-    headers = {"Authorization": f"Bearer {KOMMO_TOKEN}"}
-    payload = {
-        "note_type": "common",
-        "params": {"text": text}
-    }
+    if idempotent is None:
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+    retry_errors = httpx.TransportError if idempotent else RETRY_UNSENT_ERRORS
+    retry_statuses = RETRY_STATUSES if idempotent else RETRY_UNSAFE_STATUSES
+
+    for attempt in range(RETRY_ATTEMPTS):
+        last_attempt = attempt == RETRY_ATTEMPTS - 1
+        r = None
+        try:
+            r = await http.request(method, url, **kwargs)
+        except retry_errors:
+            if last_attempt:
+                raise
+        else:
+            if r.status_code not in retry_statuses or last_attempt:
+                return r
+
+        delay = _retry_delay(attempt, r)
+        logger.warning(
+            "%s %s falhou (%s); nova tentativa em %.1fs",
+            method, url, r.status_code if r is not None else "erro de rede", delay,
+        )
+        await asyncio.sleep(delay)
+
+
+async def add_kommo_notes(lead_id: int, texts: list[str]):
+    """
+    Adiciona várias notas ao lead no Kommo em uma única requisição
+    """
+    payload = [
+        {
+            "entity_id": int(lead_id),
+            "note_type": "common",
+            "params": {"text": text}
+        }
+        for text in texts
+    ]
     try:
-        r = requests.post(url, json=payload, headers=headers, timeout=10)
-        log("Nota adicionada:", r.status_code, r.text[:200])
+        r = await request_with_retry(kommo_client, "POST", "/leads/notes", content=orjson.dumps(payload))
+        logger.info("Notas adicionadas: %d %s %.200s", len(payload), r.status_code, r.text)
     except Exception as e:
-        log("Erro ao adicionar nota:", repr(e))
+        logger.error("Erro ao adicionar notas: %r", e)
 
 
-def update_lead_stage(lead_id: int, stage_id: str):
+async def update_lead_stage(lead_id: int, status_id: int):
     """
     Atualiza etapa do lead no Kommo
     """
-    url = f"https://{KOMMO_DOMAIN}/api/v4/leads/{lead_id}"
-    headers = {"Authorization": f"Bearer {KOMMO_TOKEN}"}
+    payload = {"status_id": status_id}
+
+    # status_id absoluto: repetir o PATCH não muda o resultado
+    try:
+        r = await request_with_retry(
+            kommo_client, "PATCH", f"/leads/{lead_id}", idempotent=True, content=orjson.dumps(payload)
+        )
+        logger.info("Mudança de etapa: %s %.200s", r.status_code, r.text)
+    except Exception as e:
+        logger.error("Erro ao atualizar etapa: %r", e)
+
+
+def build_return_body(visible: str) -> dict:
+    """
+    Corpo do return_url: mensagem completa + handler "show" com até 80 caracteres
+    """
+    # A maioria das respostas já cabe em 80 caracteres: nem chega a fatiar
+    short_message = visible if len(visible) <= 80 else visible[:80]
 
-    payload = {"status_id": stage_id}
+    return {
+        "data": {"message": visible},
+        "execute_handlers": [
+            {
+                "handler": "show",
+                "params": {"type": "text", "value": short_message}
+            }
+        ]
+    }
+
+
+async def post_return_url(return_url: str, visible: str):
+    """
+    Devolve a resposta da Erika ao Salesbot pelo return_url
+    """
+    body = build_return_body(visible)
 
     try:
-        r = requests.patch(url, json=payload, headers=headers, timeout=10)
-        log("Mudança de etapa:", r.status_code, r.text[:200])
+        logger.info("POST -> return_url: %s", return_url)
+        r = await request_with_retry(
+            http_client, "POST", return_url, content=orjson.dumps(body), headers=JSON_HEADERS
+        )
+        logger.info("Resposta return_url: %s %.300s", r.status_code, r.text)
     except Exception as e:
-        log("Erro ao atualizar etapa:", repr(e))
+        logger.error("Erro ao chamar return_url: %r", e)
+
+
+async def read_body_fast(request: Request) -> bytes:
+    """
+    Lê o corpo do webhook com limite de tamanho; acima de MAX_BODY_BYTES
+    (declarado no Content-Length ou recebido de fato) responde 413
+    """
+    try:
+        size = int(request.headers.get("content-length", ""))
+    except ValueError:
+        size = 0
+
+    if size > MAX_BODY_BYTES:
+        raise HTTPException(413, "Payload muito grande")
+
+    # b"".join de um único chunk devolve o próprio objeto, sem cópia
+    chunks = []
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > MAX_BODY_BYTES:
+            raise HTTPException(413, "Payload muito grande")
+        chunks.append(chunk)
+
+    return b"".join(chunks)
+
+
+def parse_kommo_form(raw: bytes) -> dict:
+    """
+    Lê do form-urlencoded apenas os campos conhecidos, em uma passada,
+    já no formato aninhado do KommoPayload
+    """
+    payload = {}
+
+    for pair in raw.split(b"&"):
+        key, sep, value = pair.partition(b"=")
+        if not sep:
+            continue
+        if b"%" in key:
+            key = unquote_to_bytes(key)
+
+        path = _FORM_FIELDS.get(key)
+        if path is None:
+            continue
+
+        node = payload
+        for part in path[:-1]:
+            node = node.setdefault(part, {})
+            if not isinstance(node, dict):
+                break
+        else:
+            value = unquote_to_bytes(value.replace(b"+", b" ")).decode("utf-8")
+            node.setdefault(path[-1], value)
+
+    return payload
+
+
+def is_duplicate_webhook(lead_id, message_text: str, return_url) -> bool:
+    """
+    Marca o webhook como visto e diz se ele já tinha chegado nos últimos minutos.
+    O return_url é único por execução do Salesbot; sem ele, usa lead + texto
+    """
+    raw_key = return_url or f"{lead_id}:{message_text}"
+    key = hashlib.blake2b(raw_key.encode(), digest_size=16).digest()
+    now = time.monotonic()
+
+    # TTL fixo: a ordem de inserção é a ordem de expiração
+    while SEEN_WEBHOOKS:
+        oldest = next(iter(SEEN_WEBHOOKS))
+        if SEEN_WEBHOOKS[oldest] > now and len(SEEN_WEBHOOKS) < WEBHOOK_DEDUP_MAX:
+            break
+        del SEEN_WEBHOOKS[oldest]
+
+    if key in SEEN_WEBHOOKS:
+        return True
+
+    SEEN_WEBHOOKS[key] = now + WEBHOOK_DEDUP_TTL
+    return False
+
+
+def is_authorized_subdomain(raw: bytes, is_json: bool) -> bool:
+    """
+    Triagem do subdomínio da conta Kommo sem interpretar o payload inteiro;
+    a confirmação em account.subdomain vem depois, em is_authorized_account
+    """
+    if not AUTHORIZED_SUBDOMAIN:
+        return True
+
+    # Outros objetos também podem ter "subdomain": basta um bater, e a
+    # confirmação no account.subdomain fica para is_authorized_account
+    pattern = _SUBDOMAIN_JSON_RE if is_json else _SUBDOMAIN_FORM_RE
+    for match in pattern.finditer(raw):
+        subdomain = match.group(1)
+        if not is_json:
+            subdomain = unquote_to_bytes(subdomain.replace(b"+", b" "))
+        if subdomain.decode("utf-8", "replace").strip().lower() == AUTHORIZED_SUBDOMAIN:
+            return True
+    return False
+
+
+def is_authorized_account(payload: KommoPayload) -> bool:
+    """
+    Confere o account.subdomain do payload já validado (o regex acima acha
+    o primeiro "subdomain" em qualquer lugar do corpo)
+    """
+    if not AUTHORIZED_SUBDOMAIN:
+        return True
+
+    subdomain = payload.account.subdomain if payload.account else None
+    return bool(subdomain) and subdomain.strip().lower() == AUTHORIZED_SUBDOMAIN
 
 
 def extract_visible_and_action(text: str):
@@ -82,62 +465,487 @@ def extract_visible_and_action(text: str):
     (texto para cliente)
     ---ERIKA_ACTION---
     (estrutura JSON)
+
+    A ação é sempre um dict (vazio se não houver bloco válido)
     """
-    if "---VISIBLE---" in text and "---ERIKA_ACTION---" in text:
-        parts = text.split("---VISIBLE---")[1].split("---ERIKA_ACTION---")
-        visible = parts[0].strip()
-        action_raw = parts[1].strip()
+    # O bloco de ação fica no fim: rfind acha o marcador varrendo de trás
+    # para frente, e sem ele nem procuramos o ---VISIBLE---
+    action_start = text.rfind(ACTION_MARKER)
+    if action_start == -1:
+        return text, {}
 
-        try:
-            action = json.loads(action_raw)
-        except:
-            log("Falha ao interpretar ERIKA_ACTION como json.")
-            action = None
+    visible_start = text.rfind(VISIBLE_MARKER, 0, action_start)
+    if visible_start == -1:
+        return text, {}
 
-        return visible, action
+    visible = text[visible_start + len(VISIBLE_MARKER):action_start].strip()
+    action_raw = text[action_start + len(ACTION_MARKER):].strip()
 
-    return text, None
+    try:
+        action = orjson.loads(action_raw)
+    except orjson.JSONDecodeError:
+        logger.warning("Falha ao interpretar ERIKA_ACTION como json.")
+        return visible, {}
 
+    if not isinstance(action, dict):
+        return visible, {}
+    return visible, action
 
-def call_erika_assistant(message: str):
+
+async def _stream_run(thread_id: str):
     """
-    Chama o Assistant da Erika (OpenAI)
+    Executa o run em streaming (SSE): termina assim que a OpenAI encerra o run,
+    sem polling, e já traz as mensagens geradas por ele
+    """
+    async with client.beta.threads.runs.stream(
+        thread_id=thread_id,
+        assistant_id=OPENAI_ASSISTANT_ID,
+    ) as stream:
+        run = await stream.get_final_run()
+        if run.status != "completed":
+            return run, []
+        return run, await stream.get_final_messages()
+
+
+def _remember(store: dict, lead_id, value):
+    """
+    Grava o valor do lead como o mais recente, descartando os mais antigos
+    além de MAX_CACHED_LEADS
+    """
+    store.pop(lead_id, None)
+    store[lead_id] = value
+
+    while len(store) > MAX_CACHED_LEADS:
+        store.pop(next(iter(store)))
+
+
+def _lead_lock(lead_id):
+    """
+    Lock por lead: um thread não aceita mensagens enquanto há um run ativo
+    """
+    if not lead_id:
+        return asyncio.Lock()
+
+    lock = LEAD_LOCKS.get(lead_id)
+    if lock is None:
+        if len(LEAD_LOCKS) >= MAX_CACHED_LEADS:
+            # Só locks livres podem sair; um lock em uso ainda protege um run
+            for key in [k for k, v in LEAD_LOCKS.items() if not v.locked()]:
+                del LEAD_LOCKS[key]
+        lock = LEAD_LOCKS[lead_id] = asyncio.Lock()
+    return lock
+
+
+async def get_lead_thread(lead_id):
+    """
+    Reaproveita o thread do lead (TTL renovado a cada uso) ou cria um novo
+    """
+    now = time.monotonic()
+    entry = LEAD_THREADS.get(lead_id) if lead_id else None
+
+    if entry and entry[1] > now:
+        thread_id = entry[0]
+    else:
+        thread = await client.beta.threads.create()
+        thread_id = thread.id
+
+    if lead_id:
+        _remember(LEAD_THREADS, lead_id, (thread_id, now + LEAD_THREAD_TTL))
+
+    return thread_id
+
+
+async def _cancel_active_run(thread_id: str):
+    """
+    Cancela o run que ainda estiver ativo no thread (após timeout ou erro)
     """
     try:
-        thread = client.beta.threads.create()
-        client.beta.threads.messages.create(
-            thread_id=thread.id,
-            role="user",
-            content=message,
-        )
+        runs = await client.beta.threads.runs.list(thread_id=thread_id, limit=1)
+        for run in runs.data:
+            if run.status in ("queued", "in_progress", "requires_action"):
+                await client.beta.threads.runs.cancel(run_id=run.id, thread_id=thread_id)
+    except Exception as e:
+        logger.warning("Não foi possível cancelar o run do thread %s: %r", thread_id, e)
 
-        run = client.beta.threads.runs.create_and_poll(
-            thread_id=thread.id,
-            assistant_id=OPENAI_ASSISTANT_ID,
-        )
 
-        if run.status != "completed":
-            return "Desculpe, estou com dificuldades para responder agora. 😔"
+async def call_erika_assistant(message: str, lead_id=None):
+    """
+    Chama o Assistant da Erika (OpenAI) no thread da conversa do lead
+    """
+    try:
+        async with _lead_lock(lead_id):
+            thread_id = await get_lead_thread(lead_id)
+
+            try:
+                await client.beta.threads.messages.create(
+                    thread_id=thread_id,
+                    role="user",
+                    content=message,
+                )
+                run, msgs = await asyncio.wait_for(_stream_run(thread_id), MAX_RUN_SECONDS)
+            except asyncio.TimeoutError:
+                logger.warning("Run excedeu o tempo máximo no thread %s", thread_id)
+                run, msgs = None, []
+            except Exception:
+                # O run pode seguir ativo na OpenAI: o thread não é mais reaproveitado
+                LEAD_THREADS.pop(lead_id, None)
+                await _cancel_active_run(thread_id)
+                raise
+
+            if run is None or run.status != "completed":
+                # Um run preso bloquearia o thread: a próxima mensagem abre outro
+                LEAD_THREADS.pop(lead_id, None)
+                await _cancel_active_run(thread_id)
+                return ERIKA_BUSY_REPLY
 
-        msgs = client.beta.threads.messages.list(thread_id=thread.id)
         text = "\n".join(
             c.text.value
-            for m in msgs.data
+            for m in msgs
             for c in m.content
             if hasattr(c, "text")
         )
 
         return text.strip()
     except Exception as e:
-        log("Erro no assistant:", repr(e))
-        return "Ops! Algo deu errado ao falar com a Erika."
+        logger.error("Erro no assistant: %r", e)
+        return ERIKA_ERROR_REPLY
+
+
+def _lead_history(lead_id):
+    """
+    Histórico recente da conversa do lead (TTL renovado a cada uso)
+    """
+    now = time.monotonic()
+    entry = LEAD_HISTORY.get(lead_id)
+
+    if entry and entry[1] > now:
+        history = entry[0]
+    else:
+        history = deque(maxlen=ERIKA_HISTORY_MESSAGES)
+
+    _remember(LEAD_HISTORY, lead_id, (history, now + LEAD_THREAD_TTL))
+    return history
+
+
+async def call_erika_chat(message: str, lead_id=None):
+    """
+    Chama a Erika via Chat Completions: uma única ida e volta à OpenAI
+    """
+    try:
+        async with _lead_lock(lead_id):
+            history = _lead_history(lead_id) if lead_id else ()
+            user_msg = {"role": "user", "content": message}
+
+            # Prefixo estável (sistema + histórico) e só a mensagem nova no fim:
+            # a OpenAI reaproveita o prefixo já processado (prompt caching)
+            resp = await client.chat.completions.create(
+                model=OPENAI_CHAT_MODEL,
+                messages=[
+                    {"role": "system", "content": ERIKA_SYSTEM_PROMPT},
+                    *history,
+                    user_msg,
+                ],
+            )
+            text = (resp.choices[0].message.content or "").strip()
+
+            if lead_id:
+                history.append(user_msg)
+                history.append({"role": "assistant", "content": text})
+
+        return text
+    except Exception as e:
+        logger.error("Erro no chat completions: %r", e)
+        return ERIKA_ERROR_REPLY
+
+
+async def call_erika(message: str, lead_id=None):
+    """
+    Encaminha a mensagem para o backend configurado da Erika
+    """
+    if ERIKA_SYSTEM_PROMPT:
+        return await call_erika_chat(message, lead_id)
+    return await call_erika_assistant(message, lead_id)
+
+
+async def record_erika_turn(message: str, reply: str, lead_id):
+    """
+    Registra no contexto do lead (thread ou histórico) uma troca respondida
+    pelo cache, para a Erika não perder essa pergunta na próxima mensagem
+    """
+    try:
+        async with _lead_lock(lead_id):
+            if ERIKA_SYSTEM_PROMPT:
+                history = _lead_history(lead_id)
+                history.append({"role": "user", "content": message})
+                history.append({"role": "assistant", "content": reply})
+                return
+
+            thread_id = await get_lead_thread(lead_id)
+            for role, content in (("user", message), ("assistant", reply)):
+                await client.beta.threads.messages.create(
+                    thread_id=thread_id,
+                    role=role,
+                    content=content,
+                )
+    except Exception as e:
+        logger.error("Erro ao registrar resposta do cache no contexto: %r", e)
+
+
+# ============================================================
+# CACHE SEMÂNTICO
+# ============================================================
+
+class EmbeddingBatcher:
+    """
+    Agrupa pedidos de embedding concorrentes em uma única chamada à OpenAI
+    (até max_batch textos ou max_wait segundos, o que vier primeiro)
+    """
+
+    def __init__(self, max_batch: int = 16, max_wait: float = 0.02):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = None
+        self._task = None
+        self._flushes = set()
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, *self._flushes, return_exceptions=True)
+        self._task = None
+
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("EmbeddingBatcher encerrado"))
+
+    async def embed(self, text: str):
+        if self._task is None:
+            # Fora do lifespan (ex.: scripts): chamada direta
+            return (await self._create([text]))[0]
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # O envio não segura a coleta do próximo lote
+            flush = asyncio.create_task(self._flush(batch))
+            self._flushes.add(flush)
+            flush.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch):
+        try:
+            embeddings = await self._create([text for text, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), embedding in zip(batch, embeddings):
+            if not future.done():
+                future.set_result(embedding)
+
+    async def _create(self, texts: list[str]):
+        resp = await client.embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=texts,
+        )
+        return [item.embedding for item in sorted(resp.data, key=lambda d: d.index)]
+
+
+embedding_batcher = EmbeddingBatcher()
+
+
+async def embed_text(text: str):
+    """
+    Gera o embedding de uma mensagem (vetor já normalizado pela OpenAI)
+    """
+    return await embedding_batcher.embed(text)
+
+
+def _lead_cache(lead_id):
+    """
+    Retorna (criando se preciso) o cache do lead, mantendo-o como o mais recente
+    """
+    cache = SEMANTIC_CACHE.get(lead_id)
+    if cache is None:
+        cache = {"last_reply": None, "entries": deque(maxlen=SEMANTIC_CACHE_PER_LEAD)}
+    _remember(SEMANTIC_CACHE, lead_id, cache)
+    return cache
+
+
+def _cache_key(text: str) -> str:
+    """
+    Normaliza a mensagem para o acerto exato (caixa e espaços ignorados)
+    """
+    return " ".join(text.casefold().split())
+
+
+def _cache_exact(cache, key: str):
+    """
+    Acerto exato no mesmo contexto da conversa, sem precisar de embedding
+    """
+    now = time.monotonic()
+    for expires_at, cached_key, _, context, reply in cache["entries"]:
+        if cached_key == key and expires_at >= now and context == cache["last_reply"]:
+            return reply
+    return None
+
+
+def _cache_lookup(cache, embedding):
+    """
+    Busca a resposta mais similar dada no mesmo contexto da conversa
+    """
+    now = time.monotonic()
+    best_score, best_reply = 0.0, None
+
+    for expires_at, _, cached_emb, context, reply in cache["entries"]:
+        if expires_at < now or context != cache["last_reply"]:
+            continue
+        # Embeddings da OpenAI têm norma 1: produto escalar == cosseno
+        score = sum(a * b for a, b in zip(embedding, cached_emb))
+        if score > best_score:
+            best_score, best_reply = score, reply
+
+    if best_score >= SEMANTIC_CACHE_THRESHOLD:
+        return best_reply
+    return None
+
+
+async def erika_reply(lead_id, message: str):
+    """
+    Responde via cache semântico do lead quando possível; senão chama a Erika
+    """
+    if not SEMANTIC_CACHE_ENABLED or not lead_id or ACTION_MARKER in message:
+        return await call_erika(message, lead_id)
+
+    cache = _lead_cache(lead_id)
+    key = _cache_key(message)
+
+    # Mesma mensagem (caixa e espaços à parte) no mesmo ponto da conversa:
+    # responde sem gerar embedding. Como o contexto é a última resposta, só
+    # acerta quando a conversa volta exatamente ao mesmo estado
+    cached = _cache_exact(cache, key)
+    if cached is not None:
+        logger.info("Cache exato: hit para lead %s", lead_id)
+        cache["last_reply"] = cached
+        await record_erika_turn(message, cached, lead_id)
+        return cached
+
+    try:
+        embedding = await embed_text(message)
+    except Exception as e:
+        logger.error("Erro ao gerar embedding: %r", e)
+        return await call_erika(message, lead_id)
+
+    cached = _cache_lookup(cache, embedding)
+    if cached is not None:
+        logger.info("Cache semântico: hit para lead %s", lead_id)
+        cache["last_reply"] = cached
+        await record_erika_turn(message, cached, lead_id)
+        return cached
+
+    reply = await call_erika(message, lead_id)
+
+    # Respostas com ação (nota/etapa) ou de erro não são reaproveitadas
+    if reply not in (ERIKA_BUSY_REPLY, ERIKA_ERROR_REPLY) and ACTION_MARKER not in reply:
+        cache["entries"].append(
+            (time.monotonic() + SEMANTIC_CACHE_TTL, key, embedding, cache["last_reply"], reply)
+        )
+    cache["last_reply"] = reply
+
+    return reply
+
+
+async def process_message(lead_id, message_text: str, return_url):
+    """
+    Chama a Erika, devolve a resposta ao Salesbot e registra notas/etapa no Kommo
+    """
+    try:
+        # ============================
+        # CHAMAR ASSISTENTE DA ERIKA
+        # ============================
+
+        erika_raw = await erika_reply(lead_id, message_text)
+
+        visible, erika_action = extract_visible_and_action(erika_raw)
+
+        if not visible:
+            visible = "Ok! Recebi sua mensagem. 😊"
+
+        # ======================================================
+        # RETURN_URL (OBRIGATÓRIO) + INTERAÇÕES NO KOMMO
+        # ======================================================
+
+        # Nenhuma chamada depende da outra: rodam em paralelo, e o Salesbot
+        # do cliente não espera as notas e a etapa no Kommo
+        tasks = []
+
+        if lead_id:
+            # A ação vem do LLM: um campo malformado não pode impedir a
+            # devolutiva ao cliente, então as notas/etapa ficam isoladas
+            try:
+                notes = [f"Erika 🧠:\n{visible}"]
+
+                summary = erika_action.get("summary_note")
+                if summary:
+                    notes.append(f"ERIKA_ACTION: {summary}")
+
+                tasks.append(add_kommo_notes(lead_id, notes))
+
+                stage = erika_action.get("kommo_suggested_stage")
+                status_id = STAGE_STATUS_IDS.get(stage) if isinstance(stage, str) else None
+                if status_id:
+                    tasks.append(update_lead_stage(lead_id, status_id))
+            except Exception as e:
+                logger.error("Erro ao preparar notas/etapa do lead %s: %r", lead_id, e)
+
+        # Criado por último: nada acima pode deixá-lo sem ser aguardado
+        if return_url:
+            tasks.append(post_return_url(return_url, visible))
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+    except Exception as e:
+        logger.error("Erro ao processar mensagem do lead %s: %r", lead_id, e)
 
 
 # ============================================================
 # FASTAPI
 # ============================================================
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if SEMANTIC_CACHE_ENABLED:
+        embedding_batcher.start()
+    yield
+    await embedding_batcher.stop()
+    await http_client.aclose()
+    await kommo_client.aclose()
+    await client.close()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 
 @app.get("/")
@@ -146,27 +954,38 @@ def home():
 
 
 @app.post("/kommo-webhook")
-async def kommo_webhook(request: Request):
+async def kommo_webhook(request: Request, background_tasks: BackgroundTasks):
     """
     RECEBE widget_request do Kommo
-    Responde a Erika via OpenAI
-    Envia devolutiva para return_url
+    Valida e responde na hora; a Erika (OpenAI), o return_url e as
+    notas no Kommo seguem em segundo plano
     """
-    raw = await request.body()
+    raw = await read_body_fast(request)
     content_type = request.headers.get("content-type", "").lower()
+    is_json = "json" in content_type
+
+    if not is_authorized_subdomain(raw, is_json):
+        logger.warning("Subdomínio não autorizado.")
+        raise HTTPException(401, "Subdomínio não autorizado")
 
     try:
-        if "json" in content_type:
-            payload = json.loads(raw.decode("utf-8"))
+        if is_json:
+            payload = KommoPayload.model_validate_json(raw)
         else:
             # fallback: form-urlencoded
-            from urllib.parse import parse_qs
-            payload = {k: v[0] for k, v in parse_qs(raw.decode()).items()}
-    except Exception as e:
-        log("Erro ao interpretar payload:", repr(e))
+            payload = KommoPayload.model_validate(parse_kommo_form(raw))
+    except (ValidationError, UnicodeDecodeError) as e:
+        logger.error("Erro ao interpretar payload: %r", e)
         raise HTTPException(400, "Payload inválido")
 
-    log("Payload recebido:", json.dumps(payload)[:800])
+    if not is_authorized_account(payload):
+        logger.warning("Subdomínio não autorizado.")
+        raise HTTPException(401, "Subdomínio não autorizado")
+
+    logger.info("Payload recebido, chaves: %s", sorted(payload.model_fields_set))
+    if logger.isEnabledFor(logging.DEBUG):
+        # Só os primeiros 800 bytes do corpo recebido, sem re-serializar
+        logger.debug("Payload: %s", raw[:800].decode("utf-8", "replace"))
 
     # Estrutura típica:
     # {
@@ -174,86 +993,27 @@ async def kommo_webhook(request: Request):
     #   "data": { "message": "texto...", "from": "widget" },
     #   "return_url": "https://.../continue/... "
     # }
-    token = payload.get("token")
-    data = payload.get("data") or {}
-    return_url = payload.get("return_url")
-
-    # Extrair texto enviado pelo cliente
-    msg_raw = data.get("message") or data.get("text") or ""
-
-    if isinstance(msg_raw, dict):
-        message_text = msg_raw.get("text") or msg_raw.get("body") or msg_raw.get("message", "")
-    else:
-        message_text = str(msg_raw)
+    token = payload.token
+    data = payload.data or KommoData()
+    return_url = payload.return_url
 
-    message_text = message_text.strip()
+    # Texto e lead_id já resolvidos pelo KommoData na validação
+    message_text = data.message_text
+    lead_id = data.lead_id
 
     if not message_text:
-        log("Nenhuma mensagem encontrada.")
+        logger.info("Nenhuma mensagem encontrada.")
         return {"status": "ignored"}
 
-    # Extrair lead_id caso exista
-    lead_id = None
-    if isinstance(data.get("lead"), dict):
-        lead_id = data["lead"].get("id")
-    if not lead_id:
-        lead_id = data.get("lead_id")
-
-    # ============================
-    # CHAMAR ASSISTENTE DA ERIKA
-    # ============================
-
-    erika_raw = call_erika_assistant(message_text)
+    if is_duplicate_webhook(lead_id, message_text, return_url):
+        logger.info("Webhook duplicado ignorado (lead %s).", lead_id)
+        return {"status": "duplicate", "lead_id": lead_id}
 
-    visible, erika_action = extract_visible_and_action(erika_raw)
-
-    if not visible:
-        visible = "Ok! Recebi sua mensagem. 😊"
-
-    # ======================================
-    # INTERAÇÕES NO KOMMO (notas & pipeline)
-    # ======================================
-
-    if lead_id:
-        add_kommo_note(lead_id, f"Erika 🧠:\n{visible}")
-
-        if erika_action and isinstance(erika_action, dict):
-            summary = erika_action.get("summary_note")
-            if summary:
-                add_kommo_note(lead_id, f"ERIKA_ACTION: {summary}")
-
-            stage_key = erika_action.get("kommo_suggested_stage")
-            if stage_key and stage_key in STAGE_ENV_MAP:
-                update_lead_stage(lead_id, STAGE_ENV_MAP[stage_key])
-
-    # ============================
-    # CHAMAR RETURN_URL (OBRIGATÓRIO)
-    # ============================
-
-    if return_url:
-        try:
-            short_message = visible[:80]
-
-            body = {
-                "data": {"message": visible},
-                "execute_handlers": [
-                    {
-                        "handler": "show",
-                        "params": {"type": "text", "value": short_message}
-                    }
-                ]
-            }
-
-            log("POST -> return_url:", return_url)
-            r = requests.post(return_url, json=body, timeout=10)
-            log("Resposta return_url:", r.status_code, r.text[:300])
-
-        except Exception as e:
-            log("Erro ao chamar return_url:", repr(e))
+    # A Erika e as chamadas ao Kommo rodam depois da resposta: o Kommo recebe
+    # o 200 na hora e a devolutiva segue pelo return_url
+    background_tasks.add_task(process_message, lead_id, message_text, return_url)
 
     return {
-        "status": "ok",
-        "message_sent": visible,
+        "status": "accepted",
         "lead_id": lead_id,
-        "erika_action": erika_action
     }
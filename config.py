@@ -0,0 +1,69 @@
+import os
+
+# ============================================================
+# CONFIGURAÇÕES (variáveis de ambiente, lidas uma única vez)
+# ============================================================
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+OPENAI_ASSISTANT_ID = os.getenv("OPENAI_ASSISTANT_ID", "")  # Assistente da Erika
+# Com um prompt de sistema configurado, a Erika roda via Chat Completions
+# (uma única requisição por mensagem) em vez de Assistants
+ERIKA_SYSTEM_PROMPT = os.getenv("ERIKA_SYSTEM_PROMPT", "")
+# Prompts longos (persona, exemplos, schema do ERIKA_ACTION) cabem melhor num
+# arquivo; o texto é fixo durante o processo e vai sempre no início das
+# mensagens, o que mantém o prefixo elegível ao prompt caching da OpenAI
+ERIKA_SYSTEM_PROMPT_FILE = os.getenv("ERIKA_SYSTEM_PROMPT_FILE", "")
+if ERIKA_SYSTEM_PROMPT_FILE:
+    with open(ERIKA_SYSTEM_PROMPT_FILE, encoding="utf-8") as f:
+        ERIKA_SYSTEM_PROMPT = f.read().strip()
+OPENAI_CHAT_MODEL = os.getenv("OPENAI_CHAT_MODEL", "gpt-4o-mini")
+KOMMO_TOKEN = os.getenv("KOMMO_TOKEN", "")
+KOMMO_DOMAIN = os.getenv("KOMMO_DOMAIN", "")
+AUTHORIZED_SUBDOMAIN = os.getenv("AUTHORIZED_SUBDOMAIN", "").strip().lower()  # opcional
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+if not OPENAI_API_KEY:
+    raise RuntimeError("OPENAI_API_KEY não configurada.")
+
+if not OPENAI_ASSISTANT_ID and not ERIKA_SYSTEM_PROMPT:
+    raise RuntimeError("OPENAI_ASSISTANT_ID (ou ERIKA_SYSTEM_PROMPT) não configurada.")
+
+if not KOMMO_TOKEN:
+    raise RuntimeError("KOMMO_TOKEN não configurado.")
+
+if not KOMMO_DOMAIN:
+    raise RuntimeError("KOMMO_DOMAIN não configurado.")
+
+# URLs e cabeçalho da API do Kommo, montados uma única vez
+KOMMO_API_URL = f"https://{KOMMO_DOMAIN}/api/v4"
+KOMMO_AUTH_HEADER = {"Authorization": f"Bearer {KOMMO_TOKEN}"}
+
+# Corpos enviados já serializados pelo orjson (bytes), sem passar pelo json da stdlib
+JSON_HEADERS = {"Content-Type": "application/json"}
+KOMMO_JSON_HEADERS = {**KOMMO_AUTH_HEADER, **JSON_HEADERS}
+
+# Mapear etapas do funil (opcional): etapa sugerida -> variável com o status_id
+STAGE_ENV_MAP = {
+    "novo": "KOMMO_STAGE_NOVO",
+    "qualificacao": "KOMMO_STAGE_QUALIFICACAO"
+}
+
+# Resolvido uma única vez no startup (env não muda durante o processo)
+STAGE_STATUS_IDS = {}
+for _name, _env in STAGE_ENV_MAP.items():
+    _value = os.getenv(_env, "").strip()
+    if not _value:
+        continue
+    if not _value.isdigit():
+        raise RuntimeError(f"{_env} inválido.")
+    STAGE_STATUS_IDS[_name] = int(_value)
+
+# Tempo máximo de um run do Assistant (streaming)
+MAX_RUN_SECONDS = float(os.getenv("MAX_RUN_SECONDS", "300"))
+
+# Cache semântico de respostas da Erika
+# Desligado por padrão: cada mensagem passaria a esperar um embedding antes
+# da Erika, e o reaproveitamento só vale no mesmo ponto da conversa
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "0") == "1"
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
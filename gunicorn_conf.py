@@ -0,0 +1,26 @@
+import os
+
+# ============================================================
+# GUNICORN + UVICORN WORKERS
+# ============================================================
+# Uso: gunicorn -c gunicorn_conf.py app:app
+#
+# Threads e histórico por lead, locks, deduplicação de webhooks e cache de
+# respostas vivem na memória do processo. Com mais de um worker, as mensagens
+# de um lead se espalham entre processos (cada um com parte da conversa) e um
+# reenvio do Kommo em outro worker não é reconhecido como duplicado. Por isso
+# o padrão é 1 worker; um único event loop já atende muitos webhooks
+# simultâneos, pois todo o trabalho é I/O.
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+
+# Só aumente WEB_CONCURRENCY se aceitar os efeitos acima
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+# O UvicornWorker usa loop="auto" e http="auto": com uvloop e httptools
+# instalados (requirements.txt), o event loop roda sobre a libuv e o
+# parse HTTP é feito em C, sem configuração extra
+worker_class = "uvicorn.workers.UvicornWorker"
+
+keepalive = 75
+timeout = 120
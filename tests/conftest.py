@@ -0,0 +1,10 @@
+import os
+import sys
+
+# config.py exige estas variáveis no import; valores fictícios bastam para os testes
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("OPENAI_ASSISTANT_ID", "asst_test")
+os.environ.setdefault("KOMMO_TOKEN", "test")
+os.environ.setdefault("KOMMO_DOMAIN", "acme.kommo.com")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,192 @@
+import asyncio
+
+import httpx
+import pytest
+
+import app
+
+
+# ============================================================
+# FORM-URLENCODED
+# ============================================================
+
+def _form_payload(raw: bytes) -> app.KommoPayload:
+    return app.KommoPayload.model_validate(app.parse_kommo_form(raw))
+
+
+def test_form_message_add_shape_carries_lead_id():
+    raw = (
+        b"message%5Badd%5D%5B0%5D%5Btext%5D=ola+mundo"
+        b"&message%5Badd%5D%5B0%5D%5Bentity_id%5D=55"
+        b"&account%5Bsubdomain%5D=acme"
+    )
+    payload = _form_payload(raw)
+
+    assert payload.data.message_text == "ola mundo"
+    assert payload.data.lead_id == 55
+    assert payload.account.subdomain == "acme"
+
+
+@pytest.mark.parametrize("key", [b"lead[id]", b"leads[0][id]", b"data[lead_id]", b"data[lead][id]"])
+def test_form_lead_id_keys(key):
+    payload = _form_payload(key + b"=9&data[message]=oi")
+    assert payload.data.lead_id == 9
+
+
+def test_form_ignores_unknown_fields():
+    assert app.parse_kommo_form(b"foo=1&bar[baz]=2&semvalor") == {}
+
+
+def test_message_object_without_text_falls_back_to_data_text():
+    data = app.KommoData.model_validate_json(b'{"message": {}, "text": "hello"}')
+    assert data.message_text == "hello"
+
+
+def test_message_text_is_not_a_payload_field():
+    data = app.KommoData.model_validate_json(b'{"message_text": "x", "message": " oi "}')
+    assert data.message_text == "oi"
+    assert "message_text" not in app.KommoData.model_fields
+
+
+# ============================================================
+# SUBDOMÍNIO
+# ============================================================
+
+@pytest.fixture
+def authorized(monkeypatch):
+    monkeypatch.setattr(app, "AUTHORIZED_SUBDOMAIN", "acme")
+
+
+def test_subdomain_prefilter_accepts_any_matching_occurrence(authorized):
+    raw = b'{"data": {"subdomain": "x"}, "account": {"subdomain": "ACME"}}'
+    assert app.is_authorized_subdomain(raw, is_json=True)
+
+
+def test_subdomain_prefilter_rejects_without_match(authorized):
+    assert not app.is_authorized_subdomain(b'{"account": {"subdomain": "evil"}}', is_json=True)
+    assert not app.is_authorized_subdomain(b"{}", is_json=True)
+    assert app.is_authorized_subdomain(b"x=1&account%5Bsubdomain%5D=acme", is_json=False)
+    assert not app.is_authorized_subdomain(b"myaccount[subdomain]=acme", is_json=False)
+
+
+def test_account_check_uses_account_subdomain_only(authorized):
+    spoofed = app.KommoPayload.model_validate_json(
+        b'{"data": {"subdomain": "acme"}, "account": {"subdomain": "evil"}}'
+    )
+    legit = app.KommoPayload.model_validate_json(b'{"account": {"subdomain": "acme"}}')
+
+    assert not app.is_authorized_account(spoofed)
+    assert not app.is_authorized_account(app.KommoPayload())
+    assert app.is_authorized_account(legit)
+
+
+# ============================================================
+# DEDUPLICAÇÃO
+# ============================================================
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = {"t": 1000.0}
+    monkeypatch.setattr(app.time, "monotonic", lambda: now["t"])
+    monkeypatch.setattr(app, "SEEN_WEBHOOKS", {})
+    return now
+
+
+def test_duplicate_webhook_within_ttl(clock):
+    assert not app.is_duplicate_webhook(1, "oi", "https://k/continue/1")
+    assert app.is_duplicate_webhook(1, "outro texto", "https://k/continue/1")
+    assert not app.is_duplicate_webhook(1, "oi", "https://k/continue/2")
+
+
+def test_duplicate_webhook_without_return_url_uses_lead_and_text(clock):
+    assert not app.is_duplicate_webhook(1, "oi", None)
+    assert app.is_duplicate_webhook(1, "oi", None)
+    assert not app.is_duplicate_webhook(2, "oi", None)
+
+
+def test_duplicate_webhook_expires(clock):
+    assert not app.is_duplicate_webhook(1, "oi", None)
+    clock["t"] += app.WEBHOOK_DEDUP_TTL + 1
+    assert not app.is_duplicate_webhook(1, "oi", None)
+
+
+# ============================================================
+# RETRY
+# ============================================================
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    async def _sleep(delay):
+        return None
+    monkeypatch.setattr(app.asyncio, "sleep", _sleep)
+
+
+def _mock_client(calls, error=None, status=200):
+    def handler(request):
+        calls.append(request.method)
+        if error is not None:
+            raise error("falha", request=request)
+        return httpx.Response(status)
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def _send(method, error=None, status=200, **kwargs):
+    calls = []
+
+    async def run():
+        async with _mock_client(calls, error, status) as http:
+            try:
+                return await app.request_with_retry(http, method, "https://k/x", **kwargs)
+            except httpx.TransportError:
+                return None
+
+    asyncio.run(run())
+    return len(calls)
+
+
+@pytest.mark.parametrize("error", [httpx.ReadTimeout, httpx.RemoteProtocolError])
+def test_post_not_resent_after_it_may_have_arrived(no_sleep, error):
+    assert _send("POST", error=error) == 1
+
+
+@pytest.mark.parametrize("error", [httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout])
+def test_post_retried_when_never_sent(no_sleep, error):
+    assert _send("POST", error=error) == app.RETRY_ATTEMPTS
+
+
+def test_post_retry_statuses(no_sleep):
+    assert _send("POST", status=502) == 1
+    assert _send("POST", status=429) == app.RETRY_ATTEMPTS
+
+
+def test_idempotent_requests_retry_5xx_and_read_errors(no_sleep):
+    assert _send("PATCH", status=502, idempotent=True) == app.RETRY_ATTEMPTS
+    assert _send("PATCH", error=httpx.ReadTimeout, idempotent=True) == app.RETRY_ATTEMPTS
+    assert _send("GET", status=503) == app.RETRY_ATTEMPTS
+    assert _send("PATCH", status=502) == 1
+
+
+def test_retry_delay_honours_retry_after():
+    assert app._retry_delay(0, httpx.Response(429, headers={"Retry-After": "3"})) == 3
+    assert app._retry_delay(0, httpx.Response(429, headers={"Retry-After": "999"})) == app.RETRY_MAX_DELAY
+    assert 1 <= app._retry_delay(0, httpx.Response(503)) <= 2
+
+
+# ============================================================
+# SAÍDA DA ERIKA
+# ============================================================
+
+def test_extract_visible_and_action():
+    text = '---VISIBLE---\nOlá!\n---ERIKA_ACTION---\n{"kommo_suggested_stage": "novo"}'
+    assert app.extract_visible_and_action(text) == ("Olá!", {"kommo_suggested_stage": "novo"})
+
+
+@pytest.mark.parametrize("text", [
+    "sem marcadores",
+    "---VISIBLE--- a ---ERIKA_ACTION--- {invalido",
+    "---VISIBLE--- a ---ERIKA_ACTION--- [1, 2]",
+])
+def test_extract_visible_and_action_always_returns_dict(text):
+    _, action = app.extract_visible_and_action(text)
+    assert action == {}